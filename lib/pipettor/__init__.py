@@ -1,7 +1,7 @@
 """
 Robust, easy to use Unix process pipelines.
 """
-import shlex
+import functools
 from pipettor.exceptions import PipettorException, ProcessException
 from pipettor.devices import DataReader, DataWriter, File
 from pipettor.processes import Pipeline, Popen, setDefaultLogger, getDefaultLogger, setDefaultLogLevel, getDefaultLogLevel, setDefaultLogging
@@ -9,7 +9,7 @@ from pipettor.processes import Pipeline, Popen, setDefaultLogger, getDefaultLogg
 __version__ = "1.0.0"
 
 
-def run(cmds, stdin=None, stdout=None, stderr=DataReader, logger=None, logLevel=None):
+def run(cmds, stdin=None, stdout=None, stderr=DataReader, logger=None, logLevel=None, closeFds=True):
     """Construct and run an process pipeline. If any of the processes fail,
     a ProcessException is throw.
 
@@ -23,17 +23,24 @@ def run(cmds, stdin=None, stdout=None, stderr=DataReader, logger=None, logLevel=
     be specified for `stdin`, `stdout`, or `stderr` asynchronously I/O with
     the pipeline without the danger of deadlock.
 
-    If stderr is the class DataReader, a new instance is created for each
+    If stderr is the class DataReader, stderr is collected separately for each
     process in the pipeline. The contents of stderr will include an exception
     if an occurs in that process.  If an instance of
     :class:`pipettor.DataReader` is provided, the contents of stderr from all
     process will be included in the exception.
+
+    If `closeFds` is True, all file descriptors other than stdio are closed
+    in the processes.  If False, descriptors the caller has made inheritable
+    are passed to the processes, which allows them to be started with
+    posix_spawn().  This is faster for large parent processes.  Descriptors
+    opened by pipettor are never inherited.
     """
-    Pipeline(cmds, stdin=stdin, stdout=stdout, stderr=stderr, logger=logger, logLevel=logLevel).wait()
+    Pipeline(cmds, stdin=stdin, stdout=stdout, stderr=stderr, logger=logger, logLevel=logLevel,
+             closeFds=closeFds).wait()
 
 
 def runout(cmds, stdin=None, stderr=DataReader, logger=None, logLevel=None,
-           buffering=-1, encoding=None, errors=None):
+           buffering=-1, encoding=None, errors=None, closeFds=True):
     """Construct and run an process pipeline, returning the output. If any of the
     processes fail, a ProcessException is throw.
 
@@ -45,22 +52,32 @@ def runout(cmds, stdin=None, stderr=DataReader, logger=None, logLevel=None,
 
     Specifying binary access results in data of type bytes, otherwise str type
     is return.  The buffering, encoding, and errors arguments are as used in
-    the open() function.
+    the open() function.  The closeFds argument is as used by
+    :func:`pipettor.run`.
     """
     dr = DataReader(buffering=buffering, encoding=encoding, errors=errors)
-    Pipeline(cmds, stdin=stdin, stdout=dr, stderr=stderr, logger=logger, logLevel=logLevel).wait()
+    Pipeline(cmds, stdin=stdin, stdout=dr, stderr=stderr, logger=logger, logLevel=logLevel,
+             closeFds=closeFds).wait()
     return dr.data
 
 
+@functools.lru_cache(maxsize=256)
+def _lexcmd(cmd):
+    """split a command string into arguments, caching the results, as the
+    same command is often run repeatedly"""
+    import shlex  # only needed by runlex functions, import on demand
+    return tuple(shlex.split(cmd))
+
+
 def _lexcmds(cmds):
     """spit pipeline specification into arguments"""
     if isinstance(cmds, str):
-        return shlex.split(cmds)
+        return list(_lexcmd(cmds))
     else:
-        return [shlex.split(cmd) if isinstance(cmd, str) else cmd for cmd in cmds]
+        return [list(_lexcmd(cmd)) if isinstance(cmd, str) else cmd for cmd in cmds]
 
 
-def runlex(cmds, stdin=None, stdout=None, stderr=DataReader, logger=None, logLevel=None):
+def runlex(cmds, stdin=None, stdout=None, stderr=DataReader, logger=None, logLevel=None, closeFds=True):
     """Call :func:`pipettor.run`, first splitting commands specified as strings
     are split into arguments using `shlex.split`.
 
@@ -69,11 +86,12 @@ def runlex(cmds, stdin=None, stdout=None, stderr=DataReader, logger=None, logLev
     Elements that are strings are split into arguments to form commands.
     Elements that are lists are treated as commands without splitting.
     """
-    run(_lexcmds(cmds), stdin=stdin, stdout=stdout, stderr=stderr, logger=logger, logLevel=None)
+    run(_lexcmds(cmds), stdin=stdin, stdout=stdout, stderr=stderr, logger=logger, logLevel=None,
+        closeFds=closeFds)
 
 
 def runlexout(cmds, stdin=None, stderr=DataReader, logger=None, logLevel=None,
-              buffering=-1, encoding=None, errors=None):
+              buffering=-1, encoding=None, errors=None, closeFds=True):
     """Call :func:`pipettor.runout`, first splitting commands specified
     as strings are split into arguments using `shlex.split`.
 
@@ -87,17 +105,18 @@ def runlexout(cmds, stdin=None, stderr=DataReader, logger=None, logLevel=None,
 
     Specifying binary access results in data of type bytes, otherwise str type
     is returned.  The buffering, encoding, and errors arguments are as used in
-    the open() function.
+    the open() function.  The closeFds argument is as used by
+    :func:`pipettor.run`.
     """
     return runout(_lexcmds(cmds), stdin=stdin, stderr=stderr, logger=logger, logLevel=logLevel,
-                  buffering=buffering, encoding=encoding, errors=errors)
+                  buffering=buffering, encoding=encoding, errors=errors, closeFds=closeFds)
 
 
 # n.b. all of the library API functions and classes need to be explicitly
 # included in the docs/library.rst files
-__all__ = (PipettorException.__name__, ProcessException.__name__,
-           DataReader.__name__, DataWriter.__name__,
-           File.__name__, Pipeline.__name__, Popen.__name__,
-           setDefaultLogger.__name__, getDefaultLogger.__name__,
-           setDefaultLogLevel.__name__, getDefaultLogLevel.__name__, setDefaultLogging.__name__,
-           run.__name__, runout.__name__, runlex.__name__, runlexout.__name__)
+__all__ = ("PipettorException", "ProcessException",
+           "DataReader", "DataWriter",
+           "File", "Pipeline", "Popen",
+           "setDefaultLogger", "getDefaultLogger",
+           "setDefaultLogLevel", "getDefaultLogLevel", "setDefaultLogging",
+           "run", "runout", "runlex", "runlexout")
@@ -3,7 +3,13 @@
 pipettor interfaces to files and pipes, as well as some other IPC stuff.
 """
 import os
+import sys
+import io
 import errno
+import fcntl
+import functools
+import locale
+import tempfile
 import threading
 from pipettor.exceptions import PipettorException
 
@@ -19,6 +25,128 @@ from pipettor.exceptions import PipettorException
 #  http://bugs.python.org/issue21822
 #  http://code.activestate.com/recipes/496735-workaround-for-missed-sigint-in-multithreaded-prog/
 
+# fcntl.F_SETPIPE_SZ was added in Python 3.10
+_F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", 1031 if sys.platform.startswith("linux") else None)
+
+
+def _read_proc_int(path):
+    "read an integer from a /proc file, or None if not available"
+    try:
+        with open(path) as fh:
+            return int(fh.read())
+    except (OSError, ValueError):
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def _get_max_pipe_capacity():
+    """get the largest pipe capacity to request.  This is the system limit
+    on unprivileged processes, and a small fraction of the per-user limit on
+    pipe buffer pages.  Once a user exceeds the per-user limit, all new pipes
+    created by any of the user's processes are reduced to one page.  It is
+    computed the first time a capacity is requested, so /proc is not read
+    on import."""
+    limits = []
+    maxSize = _read_proc_int("/proc/sys/fs/pipe-max-size")
+    if maxSize is not None:
+        limits.append(maxSize)
+    softPages = _read_proc_int("/proc/sys/fs/pipe-user-pages-soft")
+    if softPages:  # zero is no limit
+        limits.append((softPages * os.sysconf("SC_PAGE_SIZE")) // 64)
+    return min(limits) if len(limits) > 0 else None
+
+
+# Capacity to request for pipes created by pipettor, or None to use the
+# system default.  Larger pipes reduce the number of reads, writes, and
+# context switches when moving large amounts of data between processes.
+# However, pipe buffers count against a per-user limit shared by all of the
+# user's processes, so this is not done by default.  Applications moving
+# large amounts of data may set it, for example, to 1 << 20.  It is only
+# supported on Linux, is limited as described in _get_max_pipe_capacity(),
+# and is silently ignored if it can't be set.
+PIPE_CAPACITY = None
+
+# amount to request in each system call when copying a file
+_COPY_SIZE = 1 << 20
+
+
+def _pipe():
+    """create a pipe, setting the capacity to PIPE_CAPACITY if requested
+    and possible, return (read_fd, write_fd)"""
+    read_fd, write_fd = os.pipe()
+    if (PIPE_CAPACITY is not None) and (_F_SETPIPE_SZ is not None):
+        capacity = PIPE_CAPACITY
+        maxCapacity = _get_max_pipe_capacity()
+        if maxCapacity is not None:
+            capacity = min(capacity, maxCapacity)
+        try:
+            fcntl.fcntl(write_fd, _F_SETPIPE_SZ, capacity)
+        except OSError:
+            pass  # keep the default size
+    return read_fd, write_fd
+
+
+def _close_fds(fds):
+    """close a collection of file descriptors, using a single closerange for
+    each run of consecutive descriptors"""
+    fds = sorted(fds)
+    i = 0
+    while i < len(fds):
+        j = i
+        while (j + 1 < len(fds)) and (fds[j + 1] == fds[j] + 1):
+            j += 1
+        if j > i:
+            os.closerange(fds[i], fds[j] + 1)
+        else:
+            os.close(fds[i])
+        i = j + 1
+
+
+# maximum number of buffers that may be passed to writev()
+try:
+    _IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    _IOV_MAX = 1024
+if _IOV_MAX <= 0:
+    _IOV_MAX = 1024
+
+# errnos indicating splice() or sendfile() is not supported for a descriptor;
+# other systems only support sendfile() to sockets
+_ZERO_COPY_UNSUPPORTED = frozenset((errno.EINVAL, errno.ENOTSOCK, errno.ENOSYS, errno.EOPNOTSUPP))
+
+
+def _get_encoding(encoding):
+    "get encoding to use, defaulting as done by open()"
+    return encoding if encoding is not None else locale.getpreferredencoding(False)
+
+
+def _encode(data, encoding, errors):
+    "encode str data to be written to a process, other data is returned as-is"
+    if isinstance(data, str):
+        return data.encode(_get_encoding(encoding), errors if errors is not None else "strict")
+    return data
+
+
+def _iov_advance(iov, cnt):
+    "return a list of the buffers in iov remaining after cnt bytes are written"
+    i = 0
+    while (i < len(iov)) and (cnt >= len(iov[i])):
+        cnt -= len(iov[i])
+        i += 1
+    iov = iov[i:]
+    if cnt > 0:
+        iov[0] = iov[0][cnt:]
+    return iov
+
+
+def _decode(buf, encoding, errors):
+    """decode bytes read from a process to str in one call, with the same
+    universal newline translation as open()"""
+    text = buf.decode(_get_encoding(encoding), errors if errors is not None else "strict")
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
+
 
 class Dev(object):
     """Base class for objects specifying process input or output.  They
@@ -27,9 +155,13 @@ class Dev(object):
 
     Derived class implement the following properties, if applicable:
        read_fd - file integer descriptor for reading
-       read_fh - file object for reading
        write_fd - file integer descriptor for writing
-       write_fh - file object for writing"""
+
+    Once the child processes have been started, _release_child_fds() hands
+    the descriptors passed to the children over to the caller, which closes
+    them.  The corresponding property is set to None, so close() does not
+    close them again."""
+    __slots__ = ()
 
     def _bind_read_to_process(self, process):
         """associate read side with child process."""
@@ -41,11 +173,18 @@ class Dev(object):
 
     def _bind_to_process(self, process, mode):
         """associate with a child process based on mode"""
-        if mode.startswith("r"):
+        if mode[:1] == "r":
             self._bind_read_to_process(process)
         else:
             self._bind_write_to_process(process)
 
+    def _release_child_fds(self):
+        """called in the parent after the child process have been started.
+        Returns a list of the file descriptors passed to the children, which
+        are no longer referenced by this object and must be closed by the
+        caller."""
+        return []
+
     def _post_start_parent(self):
         "called do any post-exec handling in the parent"
         pass
@@ -62,18 +201,22 @@ class DataReader(Dev):
 
     Specifying binary access results in data of type bytes, otherwise str type
     is returned.  The buffering, encoding, and errors arguments are as used in
-    the open() function.
+    the open() function.  Data is read as bytes and decoded once when
+    accessed, so buffering is accepted for compatibility but not used.
     """
+    __slots__ = ("binary", "encoding", "errors", "_process", "_buffer", "_data",
+                 "_thread", "_read_fd", "write_fd")
+
     def __init__(self, *, binary=False, buffering=-1, encoding=None, errors=None):
         super(DataReader, self).__init__()
         self.binary = binary
+        self.encoding = encoding
+        self.errors = errors
         self._process = None
-        self._buffer = []
+        self._buffer = bytearray()
+        self._data = None  # cached data once reading is complete
         self._thread = None
-        self.read_fh = self.write_fd = None
-        read_fd, self.write_fd = os.pipe()
-        mode = "rb" if binary else "r"
-        self.read_fh = open(read_fd, mode, buffering=buffering, encoding=encoding, errors=errors)
+        self._read_fd, self.write_fd = _pipe()
 
     def __str__(self):
         return "[DataReader]"
@@ -84,11 +227,14 @@ class DataReader(Dev):
             raise PipettorException("DataReader already bound to a process")
         self._process = process
 
-    def _post_start_parent(self):
-        "called to do any post-start handling in the parent"
-        os.close(self.write_fd)
+    def _release_child_fds(self):
+        "release the write side of the pipe to be closed by the caller"
+        fds = [self.write_fd]
         self.write_fd = None
+        return fds
 
+    def _post_start_parent(self):
+        "called to do any post-start handling in the parent"
         self._thread = threading.Thread(target=self._reader)
         self._thread.daemon = True  # see note at top of this file
         self._thread.start()
@@ -98,9 +244,9 @@ class DataReader(Dev):
         if self._thread is not None:
             self._thread.join()
             self._thread = None
-        if self.read_fh is not None:
-            self.read_fh.close()
-            self.read_fh = None
+        if self._read_fd is not None:
+            os.close(self._read_fd)
+            self._read_fd = None
         if self.write_fd is not None:
             os.close(self.write_fd)
             self.write_fd = None
@@ -108,36 +254,93 @@ class DataReader(Dev):
     def _reader(self):
         "child read thread function"
         assert self.write_fd is None
-        self._buffer.append(self.read_fh.read())
+        # read directly into a buffer, doubling it when full, to avoid
+        # allocating and copying a bytes object for each chunk.  Start small,
+        # as most data read, such as stderr, is small.
+        buf = bytearray(io.DEFAULT_BUFFER_SIZE)
+        view = memoryview(buf)
+        pos = 0
+        while True:
+            if pos == len(buf):
+                view.release()
+                buf.extend(bytes(len(buf)))
+                view = memoryview(buf)
+            cnt = os.readv(self._read_fd, [view[pos:]])
+            if cnt == 0:
+                break
+            pos += cnt
+        view.release()
+        del buf[pos:]
+        self._buffer = buf
+
+    def _get_data(self):
+        if self.binary:
+            return bytes(self._buffer)
+        else:
+            return _decode(self._buffer, self.encoding, self.errors)
 
     @property
     def data(self):
         "return buffered data as a string or bytes"
-        if self.binary:
-            return b"".join(self._buffer)
-        else:
-            return "".join(self._buffer)
+        if self._data is not None:
+            return self._data
+        data = self._get_data()
+        if (self._thread is None) and (self._read_fd is None):
+            # closed, so will not change; only convert once
+            self._data = data
+            self._buffer = None
+        return data
 
 
 class DataWriter(Dev):
     """Object to asynchronously write data to process from memory via a pipe.  A
     thread is use to prevent deadlock when both reading and writing to a child
     pipeline.  Text or binary output is determined by the type of data.
+    The data may also be a list or tuple of str or bytes chunks, which are
+    written with a minimum number of writev() calls rather than being joined.
+
+    The data may also be a file-like object with a fileno() method, in
+    which case the contents of the file, starting at the current position of
+    the file object, are copied to the pipe.  For a file that is not
+    seekable, such as a pipe, copying starts at the position of the file
+    descriptor, so any data already read into the file object's buffer is
+    not copied.  This may also be a pipe,
+    such as the stdout of another process.  On Linux, this is done with
+    splice() or sendfile() so the data does not pass through the Python
+    process.  An error copying the file is raised when the DataWriter is
+    closed, normally by the wait on the pipeline.
 
     The buffering, encoding, and errors arguments are as used in
-    the open() function.
+    the open() function.  Data is written directly to the pipe, so
+    buffering is accepted for compatibility but not used.
     """
+    __slots__ = ("_data", "encoding", "errors", "_thread", "_process",
+                 "read_fd", "write_fd", "_exception")
 
     def __init__(self, data, *, buffering=-1, encoding=None, errors=None):
         super(DataWriter, self).__init__()
-        binary = not isinstance(data, str)
+        if callable(getattr(data, "fileno", None)):
+            fd = data.fileno()  # check now, so a closed file fails before start
+            if callable(getattr(data, "seekable", None)) and data.seekable():
+                # copying is done from the file descriptor, so position it
+                # where the file object is, skipping any data that was read
+                # ahead into the file object's buffer
+                data.seek(data.tell())
+                os.lseek(fd, getattr(data, "buffer", data).tell(), os.SEEK_SET)
+        else:
+            # encode once here, so encoding errors are reported before the
+            # pipeline is started and only bytes are written to the pipe.
+            # Data is kept as a list of buffers to pass to writev().
+            chunks = data if isinstance(data, (list, tuple)) else (data,)
+            data = [memoryview(_encode(c, encoding, errors)).cast("B") for c in chunks]
+            data = [c for c in data if len(c) > 0]
         self._data = data
+        self.encoding = encoding
+        self.errors = errors
         self._thread = None
         self._process = None
-        self.read_fd = self.write_fh = None
-        self.read_fd, write_fd = os.pipe()
-        mode = "wb" if binary else "w"
-        self.write_fh = open(write_fd, mode, buffering=buffering, encoding=encoding, errors=errors)
+        self._exception = None  # error in write thread, raised by close()
+        self.read_fd, self.write_fd = _pipe()
 
     def __str__(self):
         return "[DataWriter]"
@@ -148,61 +351,195 @@ class DataWriter(Dev):
             raise PipettorException("DataWriter already bound to a process")
         self._process = process
 
-    def _post_start_parent(self):
-        "called to do any start-exec handling in the parent"
-        os.close(self.read_fd)
+    def _release_child_fds(self):
+        "release the read side of the pipe to be closed by the caller"
+        fds = [self.read_fd]
         self.read_fd = None
+        return fds
 
-        self._thread = threading.Thread(target=self._writer)
+    def _write_nonblocking(self, iov):
+        """write as much of the iov buffers as will fit in the pipe without
+        blocking, returning the number of bytes written"""
+        os.set_blocking(self.write_fd, False)
+        try:
+            return os.writev(self.write_fd, iov[:_IOV_MAX])
+        except BlockingIOError:
+            return 0
+        except BrokenPipeError:
+            return sum(len(c) for c in iov)  # don't raise error on broken pipe
+        finally:
+            os.set_blocking(self.write_fd, True)
+
+    def _start_thread(self, target):
+        self._thread = threading.Thread(target=target)
         self._thread.daemon = True  # see note at top of this file
         self._thread.start()
 
+    def _post_start_parent(self):
+        """called to do any start-exec handling in the parent. Small amounts
+        of data are written directly to the pipe, a thread is only used if
+        the data doesn't fit in the pipe"""
+        if callable(getattr(self._data, "fileno", None)):
+            self._start_thread(self._file_writer)
+            return
+        iov = self._data
+        cnt = self._write_nonblocking(iov) if len(iov) > 0 else 0
+        self._data = iov = _iov_advance(iov, cnt)
+        if len(iov) == 0:
+            self._data = None  # release views of the caller's buffers
+            os.close(self.write_fd)
+            self.write_fd = None
+        else:
+            self._start_thread(self._writer)
+
     def close(self):
-        "close pipes and terminate thread"
+        """close pipes and terminate thread, raising any error that occurred
+        in the thread"""
         if self._thread is not None:
             self._thread.join()
             self._thread = None
         if self.read_fd is not None:
             os.close(self.read_fd)
             self.read_fd = None
-        if self.write_fh is not None:
-            self.write_fh.close()
-            self.write_fh = None
+        if self.write_fd is not None:
+            os.close(self.write_fd)
+            self.write_fd = None
+        self._data = None
+        if self._exception is not None:
+            ex = self._exception
+            self._exception = None  # only raise once
+            raise ex
+
+    def _run_writer(self, write_func):
+        """run a write function in the thread, saving any error for close().
+        The pipe is always closed, so the child gets EOF"""
+        assert self.read_fd is None
+        try:
+            write_func()
+        except BrokenPipeError:
+            pass  # don't raise error on broken pipe
+        except Exception as ex:
+            self._exception = ex
+        finally:
+            self._data = None  # release views of the caller's buffers
+            os.close(self.write_fd)
+            self.write_fd = None
+
+    def _write_iov(self):
+        """write the remaining buffers, not keeping them in a local, so they
+        are not referenced by the traceback of an error"""
+        while len(self._data) > 0:
+            self._data = _iov_advance(self._data, os.writev(self.write_fd, self._data[:_IOV_MAX]))
 
     def _writer(self):
         "write thread function"
-        assert self.read_fd is None
+        self._run_writer(self._write_iov)
+
+    def _copy_file_zero(self, copy_func, in_fd):
+        """copy using splice() or sendfile(), returning False if not supported
+        for this input"""
         try:
-            self.write_fh.write(self._data)
-            self.write_fh.close()
-            self.write_fh = None
-        except IOError as ex:
-            # don't raise error on broken pipe
-            if ex.errno != errno.EPIPE:
+            while copy_func(in_fd) > 0:
+                pass
+            return True
+        except OSError as ex:
+            if ex.errno not in _ZERO_COPY_UNSUPPORTED:
                 raise
+            return False
+
+    def _copy_file(self, in_fd):
+        """copy a file to the pipe.  On Linux, splice() is used, which
+        supports files, pipes, and sockets as input, then sendfile(), which
+        was added to os before splice().  Otherwise, fall back to read and
+        write."""
+        if hasattr(os, "splice") and self._copy_file_zero(lambda fd: os.splice(fd, self.write_fd, _COPY_SIZE), in_fd):
+            return
+        if self._copy_file_zero(lambda fd: os.sendfile(self.write_fd, fd, None, _COPY_SIZE), in_fd):
+            return
+        while True:
+            buf = os.read(in_fd, _COPY_SIZE)
+            if len(buf) == 0:
+                break
+            pos = 0
+            while pos < len(buf):
+                pos += os.write(self.write_fd, buf[pos:])
+
+    def _file_writer(self):
+        "write thread function for file-like data"
+        self._run_writer(lambda: self._copy_file(self._data.fileno()))
+
+
+class _StderrFile(Dev):
+    """Collects stderr of a process in an anonymous temporary file.  This is
+    used when the DataReader class is specified for stderr, as the contents
+    are normally only needed if the process fails.  It avoids a pipe and a
+    thread for each process.  Unlike a DataReader, the parent keeps the file
+    open until the process exits, and it is only read if the process
+    failed and data was written."""
+    __slots__ = ("_raw", "_fh", "write_fd")
+
+    def __init__(self):
+        super(_StderrFile, self).__init__()
+        self._raw = b""
+        self._fh = tempfile.TemporaryFile(buffering=0)
+        self.write_fd = self._fh.fileno()
+
+    def __str__(self):
+        return "[StderrFile]"
+
+    def _read_and_close(self):
+        "read any data that was written, for reporting an error, and close the file"
+        if self._fh is not None:
+            size = os.fstat(self.write_fd).st_size
+            buf = bytearray()
+            while len(buf) < size:
+                # pread may return less than requested for large files
+                chunk = os.pread(self.write_fd, size - len(buf), len(buf))
+                if len(chunk) == 0:
+                    break
+                buf += chunk
+            self._raw = bytes(buf)
+        self.close()
+
+    def close(self):
+        "close the file without reading it"
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+            self.write_fd = None
+
+    @property
+    def data(self):
+        "return data written to the file as a string"
+        return _decode(self._raw, None, 'backslashreplace')
 
 
 class File(Dev):
     """A file path for input or output, used for specifying stdio associated
-    with files. Mode is invalued on of standard r, w, or a"""
+    with files. Mode is a standard open() mode string; it is opened for
+    reading if it contains r, otherwise for writing if it contains w, or
+    appending if it contains a.  Other mode characters, such as b, t, or +,
+    are accepted but have no effect."""
+    __slots__ = ("path", "mode", "read_fd", "write_fd", "_desc")
 
     def __init__(self, path, mode="r"):
         super(File, self).__init__()
         self.path = path
         self.mode = mode
+        self._desc = os.fsdecode(path)  # path may be bytes or path-like
         # only one of the file descriptors is ever opened
         self.read_fd = self.write_fd = None
-        if mode.find('r') >= 0:
+        if 'r' in mode:
             self.read_fd = os.open(self.path, os.O_RDONLY)
-        elif mode.find('w') >= 0:
+        elif 'w' in mode:
             self.write_fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
-        elif mode.find('a') >= 0:
+        elif 'a' in mode:
             self.write_fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o666)
         else:
-            raise PipettorException("invalid or unsupported mode '{}' opening {}".format(mode, path))
+            raise PipettorException(f"invalid or unsupported mode '{mode}' opening {path}")
 
     def __str__(self):
-        return self.path
+        return self._desc
 
     def close(self):
         "close file if open"
@@ -213,33 +550,31 @@ class File(Dev):
             os.close(self.write_fd)
             self.write_fd = None
 
-    def _post_start_parent(self):
-        """post-fork child setup."""
-        self.close()
+    def _release_child_fds(self):
+        "release the open file to be closed by the caller"
+        fds = [fd for fd in (self.read_fd, self.write_fd) if fd is not None]
+        self.read_fd = self.write_fd = None
+        return fds
 
 
 class _SiblingPipe(Dev):
     """Interprocess communication between two child process by anonymous
     pipes."""
+    __slots__ = ("read_fd", "write_fd")
 
     def __init__(self):
         super(_SiblingPipe, self).__init__()
-        self.read_fd, self.write_fd = os.pipe()
+        self.read_fd, self.write_fd = _pipe()
 
     def __str__(self):
         return "[Pipe]"
 
-    def _post_start_parent(self):
-        "called to do any post-exec handling in the parent"
-        os.close(self.read_fd)
-        self.read_fd = None
-        os.close(self.write_fd)
-        self.write_fd = None
+    def _release_child_fds(self):
+        "release both sides of the pipe to be closed by the caller"
+        fds = [fd for fd in (self.read_fd, self.write_fd) if fd is not None]
+        self.read_fd = self.write_fd = None
+        return fds
 
     def close(self):
-        if self.read_fd is not None:
-            os.close(self.read_fd)
-            self.read_fd = None
-        if self.write_fd is not None:
-            os.close(self.write_fd)
-            self.write_fd = None
+        # both ends are normally consecutive, allowing one closerange
+        _close_fds(self._release_child_fds())
@@ -7,11 +7,10 @@ from warnings import warn
 
 def _signal_num_to_name(num):
     "get name for a signal number"
-    # find name in signal namespace
-    for key in vars(signal):
-        if (getattr(signal, key) == num) and key.startswith("SIG") and (key.find("_") < 0):
-            return key
-    return "signal" + str(num)
+    try:
+        return signal.Signals(num).name
+    except ValueError:
+        return "signal" + str(num)
 
 
 class PipettorException(Exception):
@@ -4,8 +4,8 @@ Robust, easy to use Unix process pipelines.
 """
 import os
 import signal
-import shlex
 import logging
+import shutil
 import subprocess
 import enum
 from io import UnsupportedOperation
@@ -14,6 +14,9 @@ from pipettor.devices import Dev
 from pipettor.devices import DataReader
 from pipettor.devices import _SiblingPipe
 from pipettor.devices import File
+from pipettor.devices import _StderrFile
+from pipettor.devices import _close_fds
+from pipettor.devices import _pipe
 from pipettor.exceptions import PipettorException
 from pipettor.exceptions import ProcessException
 from pipettor.exceptions import _warn_error_during_error_handling
@@ -63,6 +66,21 @@ def _getLogLevelToUse(logLevel):
     "get log level to use, either what is specified or default"
     return logLevel if logLevel is not None else getDefaultLogLevel()
 
+def _find_executable(prog):
+    """Find the path to a program to run, or None to leave it to subprocess.
+    subprocess will only start a process with posix_spawn() rather than
+    fork() if the program has a directory.  This is not cached, as programs
+    may be added or removed, and PATH may contain relative directories."""
+    if os.sep in prog:
+        return None  # already has a directory
+    return shutil.which(prog)
+
+# Buffer size used by Popen when the default buffering is requested.  It is
+# larger than io.DEFAULT_BUFFER_SIZE, to reduce the number of system calls
+# reading or writing pipes, which are frequently used for large amounts of
+# data.  This may be changed by applications.
+POPEN_BUFFER_SIZE = 1 << 16
+
 class State(enum.IntEnum):
     """Current state of a process"""
     PREINIT = 0
@@ -85,19 +103,27 @@ class Process(object):
 
     If stderr is an instance of DataReader, then stderr is included in
     ProcessException on process error.  If the class DataReader is passed
-    in as stderr, a DataReader object is created.
+    in as stderr, stderr is collected in a temporary file and included
+    in the ProcessException on error.
+
+    If closeFds is True, all file descriptors other than stdio are closed
+    in the child.  If False, descriptors the caller has made inheritable are
+    passed to the child; descriptors opened by pipettor are never
+    inherited.  Setting it to False allows subprocess to start the process
+    with posix_spawn(), which is faster for large parent processes.
 
     start() must be called to run process
     """
 
-    def __init__(self, cmd, stdin=None, stdout=None, stderr=None):
+    def __init__(self, cmd, stdin=None, stdout=None, stderr=None, *, closeFds=True):
         self.lock = RLock()
         self.cmd = tuple(cmd)
+        self.closeFds = closeFds
         # stdio and argument Dev association
         self.stdin = self._stdio_assoc(stdin, "r")
         self.stdout = self._stdio_assoc(stdout, "w")
         if stderr == DataReader:
-            stderr = DataReader(errors='backslashreplace')
+            stderr = _StderrFile()
         self.stderr = self._stdio_assoc(stderr, "w")
         self.popen = None
         self.pid = None
@@ -106,10 +132,14 @@ class Process(object):
         self.procExcept = None  # exception because of failed process
         self.state = State.PREINIT
         self.forced = False    # force termination during error cleanup
+        self._desc = None      # cached description
 
     def __str__(self):
         "get simple description of process"
-        return " ".join([shlex.quote(str(arg)) for arg in self.cmd])
+        if self._desc is None:
+            import shlex  # import on demand, as only needed for descriptions
+            self._desc = " ".join([shlex.quote(str(arg)) for arg in self.cmd])
+        return self._desc
 
     def _stdio_assoc(self, spec, mode):
         """pre-fork check a stdio spec validity and associate Dev or file
@@ -124,29 +154,35 @@ class Process(object):
         elif isinstance(spec, str):
             return File(spec, mode)
         else:
-            raise PipettorException("invalid stdio specification object type: {} {}".format(type(spec), spec))
+            raise PipettorException(f"invalid stdio specification object type: {type(spec)} {spec}")
 
     def _get_child_stdio(self, spec, stdfd):
-        """get fd to pass to child as one of the stdio handles."""
+        """get fd to pass to child as one of the stdio handles, None if
+        inherited."""
         if spec is None:
-            return stdfd
+            return None
         elif isinstance(spec, int):
             return spec
         elif isinstance(spec, Dev):
             return spec.read_fd if stdfd == 0 else spec.write_fd
         else:
             # this should have been detected earlier
-            raise PipettorException("_get_child_stdio logic error: {} {}".format(type(spec), stdfd))
+            raise PipettorException(f"_get_child_stdio logic error: {type(spec)} {stdfd}")
 
     def _start_process(self):
         """Do work of starting the process"""
         self.state = State.STARTUP    # do first to prevent restarts on error
 
+        # Inherited stdio is passed as None rather than 0, 1, or 2.  With
+        # closeFds False and the program found, this allows subprocess to
+        # start the process with posix_spawn() rather than fork() and exec().
         try:
             self.popen = subprocess.Popen(self.cmd,
+                                          executable=None if self.closeFds else _find_executable(self.cmd[0]),
                                           stdin=self._get_child_stdio(self.stdin, 0),
                                           stdout=self._get_child_stdio(self.stdout, 1),
-                                          stderr=self._get_child_stdio(self.stderr, 2))
+                                          stderr=self._get_child_stdio(self.stderr, 2),
+                                          close_fds=self.closeFds)
         except Exception as ex:
             raise ProcessException(str(self)) from ex
         self.pid = self.popen.pid
@@ -171,17 +207,20 @@ class Process(object):
         "determined if been detected as finished (waited on)"
         return self.state is State.FINISHED
 
-    def _parent_stdio_exit_close(self):
-        "close devices on edit"
+    def _parent_stdio_exit_close(self, failed):
+        """close devices on exit.  Stderr collected in a file is only read
+        if the process failed"""
         # MUST do before reading stderr in _handle_error_exit
         for std in (self.stdin, self.stdout, self.stderr):
-            if isinstance(std, Dev):
+            if isinstance(std, _StderrFile) and failed:
+                std._read_and_close()
+            elif isinstance(std, Dev):
                 std.close()
 
     def _handle_error_exit(self):
         # get saved stderr, if possible
         stderr = None
-        if isinstance(self.stderr, DataReader):
+        if isinstance(self.stderr, (DataReader, _StderrFile)):
             stderr = self.stderr.data
         # don't save exception if we force it to be killed
         if not self.forced:
@@ -194,8 +233,9 @@ class Process(object):
         self.returncode = os.WEXITSTATUS(waitStat) if os.WIFEXITED(waitStat) else -os.WTERMSIG(waitStat)
         # must tell subprocess.Popen about this
         self.popen.returncode = self.returncode
-        self._parent_stdio_exit_close()  # MUST DO BEFORE _handle_error_exit
-        if not ((self.returncode == 0) or (self.returncode == -signal.SIGPIPE)):
+        failed = not ((self.returncode == 0) or (self.returncode == -signal.SIGPIPE))
+        self._parent_stdio_exit_close(failed)  # MUST DO BEFORE _handle_error_exit
+        if failed:
             self._handle_error_exit()
 
     def _waitpid(self, flag=0):
@@ -210,6 +250,10 @@ class Process(object):
     def poll(self):
         """Check if the process has completed.  Return True if it
         has, False if it hasn't."""
+        # the state only changes to FINISHED once, so it can be checked
+        # without the lock
+        if self.state is State.FINISHED:
+            return True
         with self.lock:
             if self.state is State.FINISHED:
                 return True
@@ -245,8 +289,8 @@ class Pipeline(object):
     specified for stdin/out/err asynchronously I/O with the pipeline without
     the danger of deadlock.
 
-    If stderr is the class DataReader, a new instance is created for each
-    process in the pipeline. The contents of stderr will include an
+    If stderr is the class DataReader, stderr is collected separately for
+    each process in the pipeline. The contents of stderr will include an
     exception if an occurs in that process.  If an instance of DataReader
     is provided, the contents of stderr from all process will be included in
     the exception.
@@ -255,36 +299,35 @@ class Pipeline(object):
 
     The logger argument can be the name of a logger or a logger object.  If
     none, default is user.
+
+    If closeFds is True, all file descriptors other than stdio are closed in
+    the processes.  If False, descriptors the caller has made inheritable
+    are passed to all processes, which allows them to be started with
+    posix_spawn().  This is faster for large parent processes.  Descriptors
+    opened by pipettor are never inherited.
     """
     def __init__(self, cmds, *, stdin=None, stdout=None, stderr=DataReader,
-                 logger=None, logLevel=None):
+                 logger=None, logLevel=None, closeFds=True):
         self.lock = RLock()
         self.stdin = stdin
         self.stdout = stdout
         self.stderr = stderr
+        self.closeFds = closeFds
         self.procs = []
-        self.devs = set()
-        self.bypid = dict()    # indexed by pid
+        self.devs = []  # in order of creation
         self.state = State.PREINIT
         self.logger = _getLoggerToUse(logger)
         self.logLevel = _getLogLevelToUse(logLevel)
+        self._desc = None  # cached description
 
         if isinstance(cmds[0], str):
             cmds = [cmds]  # one-process pipeline
-        cmds = self._stringify(cmds)
         try:
             self._setup_processes(cmds)
         except BaseException:
             self._error_cleanup()
             raise
 
-    @staticmethod
-    def _stringify(cmds):
-        ncmds = []
-        for cmd in cmds:
-            ncmds.append([str(a) for a in cmd])
-        return ncmds
-
     @property
     def running(self):
         "determined if this process has been running"
@@ -302,13 +345,15 @@ class Pipeline(object):
             kwargs = {}
             if ex is not None:
                 kwargs["exc_info"] = ex
-            self.logger.log(level, "{}: {}".format(message, str(self)), **kwargs)
+            self.logger.log(level, "%s: %s", message, self, **kwargs)
 
     def _setup_processes(self, cmds):
         prevPipe = None
         lastCmdIdx = len(cmds) - 1
-        for i in range(len(cmds)):
-            prevPipe = self._add_process(cmds[i], prevPipe, (i == lastCmdIdx), self.stdin, self.stdout, self.stderr)
+        for i, cmd in enumerate(cmds):
+            # most arguments are already str, so don't call str() on them
+            cmd = [a if type(a) is str else str(a) for a in cmd]
+            prevPipe = self._add_process(cmd, prevPipe, (i == lastCmdIdx), self.stdin, self.stdout, self.stderr)
 
     def _add_process(self, cmd, prevPipe, isLastCmd, stdinFirst, stdoutLast, stderr):
         """add one process to the pipeline, return the output pipe if not the last process"""
@@ -331,15 +376,21 @@ class Pipeline(object):
 
     def _create_process(self, cmd, stdin, stdout, stderr):
         """create process and track Dev objects"""
-        proc = Process(cmd, stdin, stdout, stderr)
+        proc = Process(cmd, stdin, stdout, stderr, closeFds=self.closeFds)
         self.procs.append(proc)
         # Proc maybe have wrapped a Dev
         for std in (proc.stdin, proc.stdout, proc.stderr):
-            if isinstance(std, Dev):
-                self.devs.add(std)
+            if isinstance(std, Dev) and (std not in self.devs):
+                self.devs.append(std)
 
     def __str__(self):
         """get a string describing the pipe"""
+        if self._desc is None:
+            self._desc = self._describe()
+        return self._desc
+
+    def _describe(self):
+        "build the description of the pipe"
         desc = str(self.procs[0])
         if self.stdin not in (None, 0):
             desc += " <" + str(self.stdin)
@@ -353,15 +404,17 @@ class Pipeline(object):
             desc += " 2>" + str(self.stderr)
         return desc
 
-    def _start_process(self, proc):
-        proc._start()
-        self.bypid[proc.pid] = proc
-
     def _start_processes(self):
         for proc in self.procs:
-            self._start_process(proc)
+            proc._start()
 
     def _post_start_parent(self):
+        # close all of the child-side descriptors at once, then start
+        # any I/O threads
+        fds = []
+        for d in self.devs:
+            fds.extend(d._release_child_fds())
+        _close_fds(fds)
         for d in self.devs:
             d._post_start_parent()
 
@@ -391,11 +444,13 @@ class Pipeline(object):
 
     def _error_cleanup(self):
         """forced cleanup of child processed after failure"""
+        # processes are killed first, as closing a device waits for its I/O
+        # thread, which would block until a hung process exits
         self.state = State.FINISHED
-        for d in self.devs:
-            self._error_cleanup_dev(d)
         for p in self.procs:
             self._error_cleanup_process(p)
+        for d in self.devs:
+            self._error_cleanup_dev(d)
 
     def _start_guts(self):
         self._log(self.logLevel, "start")
@@ -448,7 +503,7 @@ class Pipeline(object):
     def _wait_on_one(self, proc):
         "wait on the next process in group to complete"
         w = os.waitpid(proc.pid, 0)
-        self.bypid[w[0]]._handle_exit(w[1])
+        proc._handle_exit(w[1])
 
     def _wait_guts(self):
         if self.state < State.RUNNING:
@@ -487,19 +542,20 @@ class Pipeline(object):
         for error recovery"""
         with self.lock:
             if self.logger is not None:
-                self.logger.log(self.logLevel, "Shutting down pipeline: {}".format(str(self)))
+                self.logger.log(self.logLevel, "Shutting down pipeline: %s", self)
             if self.state is State.RUNNING:
                 self._shutdown()
             elif self.state is not State.FINISHED:
                 self._finish()  # just clean up pipes
 
     def failed(self):
-        "check if any process failed, call after poll() or wait()"
-        with self.lock:
-            for p in self.procs:
-                if p.failed():
-                    return True
-            return False
+        """check if any process failed, call after poll() or wait().  This
+        only reads state, so it does not take the lock and does not block
+        while another thread is waiting on the pipeline."""
+        for p in self.procs:
+            if p.failed():
+                return True
+        return False
 
     def kill(self, sig=signal.SIGTERM):
         "send a signal to all of the processes in the pipeline"
@@ -528,11 +584,12 @@ class Popen(Pipeline):
     Command arguments will be converted to strings.
 
     The logger argument can be the name of a logger or a logger object.  If
-    none, default is user.
+    none, default is user.  The closeFds argument is as used by Pipeline.
 
     Specifying binary access results in data of type bytes, otherwise str type
     is returned.  The buffering, encoding, and errors arguments are as used in
-    the open() function.
+    the open() function, except the default buffering of -1 uses a buffer
+    of POPEN_BUFFER_SIZE bytes, which is larger than the open() default.
     """
 
     # note: this follows I/O _pyio.py structure, but doesn't extend class
@@ -540,7 +597,7 @@ class Popen(Pipeline):
     # with some kind of dynamic base class setting.
 
     def __init__(self, cmds, mode='r', *, stdin=None, stdout=None, logger=None, logLevel=None,
-                 buffering=-1, encoding=None, errors=None):
+                 buffering=-1, encoding=None, errors=None, closeFds=True):
         self.mode = mode
         self._pipeline_fh = None
         self._child_fd = None
@@ -553,7 +610,9 @@ class Popen(Pipeline):
             if stdin is not None:
                 raise PipettorException("can not specify stdin with write mode")
 
-        pipe_read_fd, pipe_write_fd = os.pipe()
+        if buffering == -1:
+            buffering = POPEN_BUFFER_SIZE
+        pipe_read_fd, pipe_write_fd = _pipe()
         if mode.find('r') >= 0:
             firstIn = stdin
             lastOut = pipe_write_fd
@@ -564,7 +623,8 @@ class Popen(Pipeline):
             lastOut = stdout
             self._child_fd = pipe_read_fd
             self._pipeline_fh = open(pipe_write_fd, mode, buffering=buffering, encoding=encoding, errors=errors)
-        super(Popen, self).__init__(cmds, stdin=firstIn, stdout=lastOut, logger=logger, logLevel=logLevel)
+        super(Popen, self).__init__(cmds, stdin=firstIn, stdout=lastOut, logger=logger, logLevel=logLevel,
+                                    closeFds=closeFds)
         self.start()
         os.close(self._child_fd)
         self._child_fd = None
@@ -581,8 +641,7 @@ class Popen(Pipeline):
 
     def _unsupported(self, name):
         """from _pyio.py: raise an OSError exception for unsupported operations."""
-        raise UnsupportedOperation("%s.%s() not supported" %
-                                   (self.__class__.__name__, name))
+        raise UnsupportedOperation(f"{self.__class__.__name__}.{name}() not supported")
 
     def _checkClosed(self, msg=None):
         """Internal: raise a ValueError if file is closed
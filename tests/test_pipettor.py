@@ -5,6 +5,7 @@ import sys
 import os
 import re
 import signal
+import threading
 if __name__ == '__main__':
     sys.path.insert(0, os.path.normpath(os.path.dirname(sys.argv[0])) + "/../lib")
     from testCaseBase import TestCaseBase, LoggerForTests
@@ -97,6 +98,60 @@ class PipelineTests(PipettorTestBase):
         self.assertTrue(pl.finished)
         self.commonChecks(nopen, pl, "true 2>[DataReader]")
 
+    def testFailedWhileWaiting(self):
+        # failed() doesn't block while another thread holds the lock waiting
+        # on the pipeline.  The process runs until its stdin is closed.
+        nopen = self.numOpenFiles()
+        rfd, wfd = os.pipe()
+        pl = Pipeline(("cat",), stdin=rfd, stdout="/dev/null")
+        pl.start()
+        os.close(rfd)
+        locked = threading.Event()
+
+        def waitLocked():
+            with pl.lock:
+                locked.set()
+                pl.wait()
+
+        waiter = threading.Thread(target=waitLocked)
+        waiter.start()
+        locked.wait()
+        results = []
+        checker = threading.Thread(target=lambda: results.append(pl.failed()))
+        checker.start()
+        checker.join(10.0)
+        checkerBlocked = checker.is_alive()
+        os.close(wfd)  # let the process exit
+        waiter.join()
+        checker.join()
+        self.assertFalse(checkerBlocked)
+        self.assertEqual(results, [False])
+        self.assertTrue(pl.finished)
+        self.commonChecks(nopen, pl, "cat <{} >/dev/null 2>[DataReader]".format(rfd))
+
+    def _checkInheritedFd(self, closeFds, expect):
+        # check if an inheritable descriptor is open in the child
+        rfd, wfd = os.pipe()
+        os.set_inheritable(wfd, True)
+        try:
+            dr = DataReader()
+            Pipeline(("sh", "-c", f"if [ -e /dev/fd/{wfd} ] ; then echo open ; else echo closed ; fi"),
+                     stdout=dr, closeFds=closeFds).wait()
+            self.assertEqual(dr.data, expect)
+        finally:
+            os.close(rfd)
+            os.close(wfd)
+
+    def testCloseFds(self):
+        nopen = self.numOpenFiles()
+        self._checkInheritedFd(True, "closed\n")
+        self.orphanChecks(nopen)
+
+    def testNoCloseFds(self):
+        nopen = self.numOpenFiles()
+        self._checkInheritedFd(False, "open\n")
+        self.orphanChecks(nopen)
+
     def testSimplePipe(self):
         nopen = self.numOpenFiles()
         log = LoggerForTests()
@@ -127,6 +182,14 @@ class PipelineTests(PipettorTestBase):
         self.checkProgWithError(cm.exception)
         self.orphanChecks(nopen)
 
+    def testSuccessStderrNotRead(self):
+        # stderr collected per-process is only read if the process fails
+        nopen = self.numOpenFiles()
+        pl = Pipeline(("sh", "-c", "echo warning >&2"), stderr=DataReader)
+        pl.wait()
+        self.assertEqual(pl.procs[0].stderr.data, "")
+        self.orphanChecks(nopen)
+
     def testPipeFail3Stderr(self):
         # all 3 process fail
         nopen = self.numOpenFiles()
@@ -201,10 +264,20 @@ class PipelineTests(PipettorTestBase):
         self.assertEqual(dr.data, "one\ntwo\nthree\n")
         self.commonChecks(nopen, pl, "^cat -u <\\[DataWriter\\] \\| cat -u >\\[DataReader\\] 2>\\[DataReader\\]$", isRe=True)
 
+    def testStdinMemEncodeError(self):
+        # encoding errors are reported when the DataWriter is created
+        with self.assertRaises(UnicodeEncodeError):
+            DataWriter("caf\u00e9\n", encoding="ascii")
+
     def testFileMode(self):
         with self.assertRaisesRegex(PipettorException, "^invalid or unsupported mode 'q' opening /dev/null"):
             File("/dev/null", "q")
 
+    def testFileModeText(self):
+        # text and update mode characters are accepted as with open()
+        for mode in ("rt", "r+", "wt", "w+", "at"):
+            File("/dev/null", mode).close()
+
     def testCollectStdoutErr(self):
         # independent collection of stdout and stderr
         nopen = self.numOpenFiles()
@@ -229,6 +302,85 @@ class PipelineTests(PipettorTestBase):
         self.diffBinaryExpected(".out", expectedBasename="file.binary")
         self.commonChecks(nopen, pl, "^cat <\\[DataWriter] >.*/output/test_pipettor.PipelineTests.testStdinMemBinary.out 2>\\[DataReader\\]$", isRe=True)
 
+    def testStdinFileWriter(self):
+        # copy from file object to stdin
+        nopen = self.numOpenFiles()
+        outf = self.getOutputFile(".out")
+        with open(self.getInputFile("file.binary"), "rb") as fh:
+            dw = DataWriter(fh)
+            pl = Pipeline(("cat",), stdin=dw, stdout=outf)
+            pl.wait()
+        self.diffBinaryExpected(".out", expectedBasename="file.binary")
+        self.commonChecks(nopen, pl, "^cat <\\[DataWriter] >.*/output/test_pipettor.PipelineTests.testStdinFileWriter.out 2>\\[DataReader\\]$", isRe=True)
+
+    def testStdinFileWriterPartRead(self):
+        # copy the rest of a file object that has been partly read
+        for mode in ("r", "rb"):
+            nopen = self.numOpenFiles()
+            dr = DataReader()
+            with open(self.getInputFile("simple1.txt"), mode) as fh:
+                fh.readline()
+                pl = Pipeline(("cat",), stdin=DataWriter(fh), stdout=dr)
+                pl.wait()
+            self.assertEqual(dr.data, "two\nthree\nfour\nfive\nsix\n")
+            self.orphanChecks(nopen)
+
+    def testStdinFileWriterClosed(self):
+        # file closed before the pipeline is started; error is raised by
+        # wait rather than hanging
+        nopen = self.numOpenFiles()
+        with open(self.getInputFile("file.binary"), "rb") as fh:
+            pl = Pipeline(("cat",), stdin=DataWriter(fh), stdout="/dev/null")
+        with self.assertRaisesRegex(ValueError, "I/O operation on closed file"):
+            pl.wait()
+        self.commonChecks(nopen, pl, "^cat <\\[DataWriter] >/dev/null 2>\\[DataReader\\]$", isRe=True)
+
+    def testStdinMemChunks(self):
+        # write a list of chunks, more than can be passed to one writev()
+        # and more than fits in a pipe
+        nopen = self.numOpenFiles()
+        chunks = ["line\n", b"", bytes(1000)] * 2000
+        dw = DataWriter(chunks)
+        dr = DataReader()
+        pl = Pipeline(("wc", "-c"), stdin=dw, stdout=dr)
+        pl.wait()
+        self.assertEqual(dr.data.strip(), "2010000")
+        self.commonChecks(nopen, pl, "^wc -c <\\[DataWriter] >\\[DataReader\\] 2>\\[DataReader\\]$", isRe=True)
+
+    def testStdinMemRelease(self):
+        # buffers are released once written, so a bytearray can be resized
+        nopen = self.numOpenFiles()
+        for data in (bytearray(b"one\n"), bytearray(3000001)):
+            dr = DataReader()
+            pl = Pipeline(("wc", "-c"), stdin=DataWriter(data), stdout=dr)
+            pl.wait()
+            self.assertEqual(dr.data.strip(), str(len(data)))
+            data.extend(b"more")
+        self.orphanChecks(nopen)
+
+    def testStdinPipeWriter(self):
+        # copy from a pipe to stdin
+        nopen = self.numOpenFiles()
+        rfd, wfd = os.pipe()
+        os.write(wfd, b"one\ntwo\nthree\n")
+        os.close(wfd)
+        dr = DataReader()
+        with open(rfd, "rb") as fh:
+            pl = Pipeline(("sort", "-r"), stdin=DataWriter(fh), stdout=dr)
+            pl.wait()
+        self.assertEqual(dr.data, "two\nthree\none\n")
+        self.commonChecks(nopen, pl, "^sort -r <\\[DataWriter] >\\[DataReader\\] 2>\\[DataReader\\]$", isRe=True)
+
+    def testStdinMemLarge(self):
+        # write more than fits in a pipe from memory to stdin
+        nopen = self.numOpenFiles()
+        dw = DataWriter(bytes(3000001))
+        dr = DataReader()
+        pl = Pipeline(("wc", "-c"), stdin=dw, stdout=dr)
+        pl.wait()
+        self.assertEqual(dr.data.strip(), "3000001")
+        self.commonChecks(nopen, pl, "wc -c <[DataWriter] >[DataReader] 2>[DataReader]")
+
     def testStdoutMemBinary(self):
         # binary read from stdout into memory
         nopen = self.numOpenFiles()
@@ -242,6 +394,15 @@ class PipelineTests(PipettorTestBase):
         self.diffBinaryExpected(".out", expectedBasename="file.binary")
         self.commonChecks(nopen, pl, "^cat <.*/input/file.binary >\\[DataReader] 2>\\[DataReader\\]$", isRe=True)
 
+    def testStdoutMemLarge(self):
+        # read more than the initial buffer size into memory
+        nopen = self.numOpenFiles()
+        dr = DataReader(binary=True)
+        pl = Pipeline(("head", "-c", "1000001", "/dev/zero"), stdout=dr)
+        pl.wait()
+        self.assertEqual(dr.data, bytes(1000001))
+        self.commonChecks(nopen, pl, "head -c 1000001 /dev/zero >[DataReader] 2>[DataReader]")
+
     def testWriteFile(self):
         # test write to File object
         nopen = self.numOpenFiles()
@@ -486,6 +647,18 @@ class FunctionTests(PipettorTestBase):
         self.assertEqual(out, "two\nthree\nsix\none\nfour\nfive\n")
         self.orphanChecks(nopen)
 
+    def testStdoutReadNoCloseFds(self):
+        out = runout(["sort", "-r", self.getInputFile("simple1.txt")], closeFds=False)
+        self.assertEqual(out, "two\nthree\nsix\none\nfour\nfive\n")
+
+    def testStdoutReadNewlines(self):
+        # universal newline translation when reading into memory
+        nopen = self.numOpenFiles()
+        for inName in ("simple1.dos.txt", "simple1.mac.txt"):
+            out = runout(("cat", self.getInputFile(inName)))
+            self.assertEqual(out, "one\ntwo\nthree\nfour\nfive\nsix\n")
+        self.orphanChecks(nopen)
+
     def testStdoutReadFail(self):
         # read from stdout into memory
         nopen = self.numOpenFiles()